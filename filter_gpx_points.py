@@ -9,13 +9,27 @@ from __future__ import print_function
 import argparse
 import logging
 import os
-import re
+import shutil
+import sys
+import tempfile
 #
 # Non-standard imports
 #
 import gpxpy
 import gpxpy.gpx
-import latlon
+import LatLon
+#
+# Ensure ./lib is in the lib path for local includes
+#
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
+#
+# Local imports
+#
+# pylint: disable=wrong-import-position
+from gpx_clean import add_clean_arguments, clean_events, clean_options
+from gpx_stream import (GPX_FOOTER, add_selection_arguments, iter_gpx, selection_options,
+                        serialize_event)
+from track_arrays import Track, extend_segment, finish_segment, new_segment
 #
 ##############################################################################
 #
@@ -34,97 +48,296 @@ def _get_logger():
 #
 ###############################################################################
 #
+# _spacings()
+#
+def _spacings(spacing=None):
+    '''_spacings(spacing) - Normalise a single spacing or a list of them to a list'''
+    if isinstance(spacing, (list, tuple)):
+        return [value if value else DEFAULT_DISTANCE for value in spacing] or [DEFAULT_DISTANCE]
+    return [spacing if spacing else DEFAULT_DISTANCE]
+#
+###############################################################################
+#
+# filter_levels()
+#
+def filter_levels(points=None, spacings=None, previous_points=None):
+    '''
+    filter_levels(points, spacings, previous_points=None) - Filter points for several spacings
+
+    A single pass over points: each point is converted once and measured once against
+    the last kept point of every level. Returns a list of kept points per spacing and
+    the last kept positions, pass the latter back in to continue filtering the same
+    segment from another batch of points.
+    '''
+    spacings = _spacings(spacings)
+    kept = [[] for _ in spacings]
+    previous_points = list(previous_points or [None] * len(spacings))
+    debug = _get_logger().isEnabledFor(logging.DEBUG)
+
+    for point in points or []:
+        if debug:
+            _get_logger().debug('Point at (%f,%f) -> %s', point.latitude, point.longitude,
+                                point.elevation)
+        current_point = LatLon.LatLon(point.latitude, point.longitude)
+        for level, spacing in enumerate(spacings):
+            previous_point = previous_points[level]
+            if not previous_point:
+                _get_logger().debug('No previous point!')
+            else:
+                distance = previous_point.distance(current_point)
+                if debug:
+                    _get_logger().debug('Distance between points: %f', distance)
+                if distance < spacing:
+                    continue
+            previous_points[level] = current_point
+            kept[level].append(point)
+
+    return kept, previous_points
+#
+###############################################################################
+#
+# filter_points()
+#
+def filter_points(points=None, spacing=None, previous_point=None):
+    '''
+    filter_points(points, spacing, previous_point=None) - Keep points at least spacing apart
+
+    Returns the kept points and the last kept position, pass the latter back in to
+    continue filtering the same segment from another batch of points.
+    '''
+    kept, previous_points = filter_levels(points, [spacing], [previous_point])
+    return kept[0], previous_points[0]
+#
+###############################################################################
+#
+# _filtered_name()
+#
+def _filtered_name(name=None, spacing=None):
+    '''_filtered_name(name, spacing) - Name for a filtered copy of a track'''
+    return (name or '') + " (filtered to {})".format(spacing)
+#
+###############################################################################
+#
 # process_track()
 #
 def process_track(track=None, spacing=None):
     '''
     process_track(track, spacing) - Take a GPX track and filter it to points at least spacing apart
+
+    spacing may also be a list, in which case a list with one filtered track per spacing
+    is returned, all built from a single pass over the points.
     '''
-    gpx_track = None
+    gpx_tracks = None
     if None not in [track]:
-        orig_num_points = new_num_points = 0
-        spacing = spacing if spacing else DEFAULT_DISTANCE
+        spacings = _spacings(spacing)
+        orig_num_points = 0
 
         _get_logger().info("Processing track: '%s'", track.name)
-        # Create first track in our GPX:
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx_track.name = track.name + " (filtered to {})".format(spacing)
+        # Create one track per spacing in our GPX:
+        gpx_tracks = []
+        for level_spacing in spacings:
+            gpx_track = gpxpy.gpx.GPXTrack()
+            gpx_track.name = _filtered_name(track.name, level_spacing)
+            gpx_tracks.append(gpx_track)
 
         for segment in track.segments:
-            # Create a segment in our GPX track:
-            new_segment = gpxpy.gpx.GPXTrackSegment()
-
-            current_point = previous_point = None
-
-            for point in segment.points:
-                orig_num_points += 1
-                _get_logger().debug('Point at (%f,%f) -> %s', point.latitude, point.longitude,
-                                    point.elevation)
-                current_point = LatLon.LatLon(point.latitude, point.longitude)
-                if not previous_point:
-                    _get_logger().debug('No previous point!')
-                    previous_point = current_point
-                    new_segment.points.append(point)
-                    new_num_points += 1
-                else:
-                    distance = previous_point.distance(current_point)
-                    _get_logger().debug('Distance between points: %f', distance)
-                    if distance >= spacing:
-                        previous_point = current_point
-                        new_segment.points.append(point)
-                        new_num_points += 1
+            kept, _ = filter_levels(segment.points, spacings)
+            orig_num_points += len(segment.points)
 
-            gpx_track.segments.append(new_segment)
+            for gpx_track, points in zip(gpx_tracks, kept):
+                # Create a segment in our GPX track:
+                gpx_segment = gpxpy.gpx.GPXTrackSegment()
+                gpx_segment.points = points
+                gpx_track.segments.append(gpx_segment)
 
-        _get_logger().info("Reduced points from '%s' to '%s'", orig_num_points, new_num_points)
+        for gpx_track in gpx_tracks:
+            _get_logger().info("Reduced points from '%s' to '%s' for '%s'", orig_num_points,
+                               gpx_track.get_points_no(), gpx_track.name)
 
-    return gpx_track
+        if not isinstance(spacing, (list, tuple)):
+            return gpx_tracks[0]
 
+    return gpx_tracks
 #
 ###############################################################################
 #
-# process_files()
+# filter_events()
 #
-def process_files(files=None, spacing=None):
+def filter_events(events=None, spacings=None):
     '''
-    process_files(files=[], spacing=DEFAULT_DISTANCE)
+    filter_events(events, spacings) - Stage filtering streamed track events
+
+    'track' and 'points' values become lists with one entry per spacing.
     '''
+    spacings = _spacings(spacings)
+    orig_num_points = 0
+    new_num_points = [0] * len(spacings)
+    previous_points = None
+    names = []
 
-    if None in [files]:
-        raise RuntimeError("No files to process!")
+    for kind, value in events or []:
+        if kind == 'track':
+            _get_logger().info("Processing track: '%s'", value)
+            orig_num_points = 0
+            new_num_points = [0] * len(spacings)
+            names = value = [_filtered_name(value, spacing) for spacing in spacings]
+        elif kind == 'segment':
+            previous_points = None
+        elif kind == 'points':
+            orig_num_points += len(value)
+            value, previous_points = filter_levels(value, spacings, previous_points)
+            new_num_points = [total + len(points) for total, points in zip(new_num_points, value)]
+            if not any(value):
+                continue
+        elif kind == 'end_track':
+            for name, total in zip(names, new_num_points):
+                _get_logger().info("Reduced points from '%s' to '%s' for '%s'", orig_num_points,
+                                   total, name)
+        yield kind, value
+#
+###############################################################################
+#
+# filter_tracks()
+#
+def filter_tracks(source=None, spacing=None, use_numpy=None, cleaning=None, selection=None):
+    '''
+    filter_tracks(source, spacing=DEFAULT_DISTANCE, use_numpy=None, cleaning=None,
+                  selection=None)
 
-    spacing = spacing or DEFAULT_DISTANCE
+    Library form of the filter. Filter a GPX path or file and return a list of
+    track_arrays.Track whose segments are coordinate/time arrays (numpy views when NumPy
+    is available) instead of printing GPX. With a list of spacings a list of such track
+    lists, one per spacing, is returned. cleaning is an optional dict of
+    gpx_clean.clean_events() arguments applied before filtering, selection an optional
+    dict of since, until and bbox arguments for gpx_stream.iter_gpx().
+    '''
+    if None in [source]:
+        raise RuntimeError("No GPX source to read!")
 
-    for gpx_file in files:
-        new_gpx = gpxpy.gpx.GPX()
+    spacings = _spacings(spacing)
+    levels = [[] for _ in spacings]
+    segments = []
 
-        # Parsing an existing file:
-        _get_logger().info("Processing file: '%s'", gpx_file)
-        gpx = gpxpy.parse(gpx_file)
+    events = iter_gpx(source, **(selection or {}))
+    if cleaning:
+        events = clean_events(events, **cleaning)
 
-        for track in gpx.tracks:
-            new_gpx.tracks.append(process_track=track, spacing=spacing)
+    for kind, value in filter_events(events, spacings):
+        if kind == 'track':
+            for tracks, name in zip(levels, value):
+                tracks.append(Track(name, []))
+        elif kind == 'segment':
+            segments = [new_segment() for _ in spacings]
+        elif kind == 'points':
+            for segment, points in zip(segments, value):
+                extend_segment(segment, points)
+        elif kind == 'end_segment':
+            for tracks, segment in zip(levels, segments):
+                tracks[-1].segments.append(finish_segment(segment, use_numpy))
 
-        print(clean_output(new_gpx.to_xml()))
+    return levels if isinstance(spacing, (list, tuple)) else levels[0]
+#
+###############################################################################
+#
+# level_chunks()
+#
+def level_chunks(events=None, levels=1):
+    '''
+    level_chunks(events, levels=1) - Stage serializing filter_events() output
+
+    Yields (level, text) pairs, level is None for the GPX header shared by all levels.
+    '''
+    prefixes = {}
+
+    for kind, value in events or []:
+        if kind == 'gpx':
+            prefixes = value[1]
+            yield None, serialize_event(kind, value, prefixes)
+        elif kind in ['track', 'points']:
+            for level, level_value in enumerate(value):
+                if level_value or kind == 'track':
+                    yield level, serialize_event(kind, level_value, prefixes)
+        else:
+            text = serialize_event(kind, value, prefixes)
+            for level in range(levels):
+                yield level, text
+#
+###############################################################################
+#
+# level_paths()
+#
+def level_paths(gpx_file=None, spacings=None, pattern=None):
+    '''
+    level_paths(gpx_file, spacings, pattern) - Output path of every level of an input
 
+    pattern.format(name=<input name without extension>, distance=<spacing>) per spacing.
+    '''
+    name = os.path.splitext(os.path.basename(getattr(gpx_file, 'name', 'gpx')))[0]
+    return [pattern.format(name=name, distance=level_spacing) for level_spacing in spacings]
 #
 ###############################################################################
 #
-# clean_output()
+# process_files()
 #
-def clean_output(output=None):
+def process_files(files=None, spacing=None, output=None, pattern=None, cleaning=None,
+                  selection=None):
     '''
-    clean_output(output=None)
+    process_files(files=[], spacing=DEFAULT_DISTANCE, output=sys.stdout, pattern=None,
+                  cleaning=None, selection=None)
 
-    Remove extra EOLs from gpx.to_xml()
+    Each file is streamed through read, filter and serialize generator stages, so only
+    a batch of points is held at a time. spacing may be a list to build several levels
+    of detail from one pass. With pattern each level is written to its own GPX file,
+    named by pattern.format(name=<input name>, distance=<spacing>), otherwise all levels
+    are written to output as one GPX with a track per level. cleaning is an optional
+    dict of gpx_clean.clean_events() arguments, run as an extra stage before filtering.
+    selection is an optional dict of since, until and bbox arguments for
+    gpx_stream.iter_gpx(), so points outside them are dropped while reading.
     '''
-    if output:
-        # remove some superfluous EOLs
-        point_pattern = re.compile(r'^(<trkpt [^>]*>)\n', re.MULTILINE)
-        elevation_pattern = re.compile(r'^(.*</ele>)\n', re.MULTILINE)
-        output = point_pattern.sub(r"\1", output)
-        output = elevation_pattern.sub(r"\1", output)
-    return output
+
+    if None in [files]:
+        raise RuntimeError("No files to process!")
+
+    spacings = _spacings(spacing)
+    output = output or sys.stdout
+
+    for gpx_file in files:
+        _get_logger().info("Processing file: '%s'", gpx_file)
+        events = iter_gpx(gpx_file, **(selection or {}))
+        if cleaning:
+            events = clean_events(events, **cleaning)
+        chunks = level_chunks(filter_events(events, spacings), len(spacings))
+
+        if pattern:
+            outputs = [open(path, 'w', encoding="utf8")
+                       for path in level_paths(gpx_file, spacings, pattern)]
+        else:
+            # the first level goes straight out, the rest wait in temporary files
+            outputs = [output] + [tempfile.TemporaryFile('w+', encoding="utf8")
+                                  for _ in spacings[1:]]
+        try:
+            for level, chunk in chunks:
+                if level is None:
+                    for level_output in outputs if pattern else outputs[:1]:
+                        level_output.write(chunk)
+                else:
+                    outputs[level].write(chunk)
+
+            if pattern:
+                for level_output in outputs:
+                    level_output.write(GPX_FOOTER)
+                _get_logger().info("Wrote '%s' levels to '%s'", len(outputs),
+                                   ', '.join(level_output.name for level_output in outputs))
+            else:
+                for level_output in outputs[1:]:
+                    level_output.seek(0)
+                    shutil.copyfileobj(level_output, output)
+                output.write(GPX_FOOTER)
+        finally:
+            for level_output in outputs:
+                if level_output is not output:
+                    level_output.close()
+
 #
 ###############################################################################
 #
@@ -145,14 +358,22 @@ def main():
                         help='Which GPX file to process. Repeat to '
                         'process multiple files.')
 
+    add_selection_arguments(parser)
+
+    add_clean_arguments(parser)
+
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Enable additional output')
 
-    parser.add_argument('-d', '--distance', default=DEFAULT_DISTANCE,
-                        action='store', type=float,
-                        help=('Minimum distance between points for inclusion. '
+    parser.add_argument('-d', '--distance', default=[], action='append', type=float,
+                        help=('Minimum distance between points for inclusion. Repeat to '
+                              'build several levels of detail in one pass. '
                               'Default: {}'.format(DEFAULT_DISTANCE)))
 
+    parser.add_argument('-o', '--output', default=None,
+                        help=('Write each level to its own file instead of one combined GPX on '
+                              'stdout, e.g. "{name}_{distance}.gpx"'))
+
     parser.add_argument('-l', '--log-level', action='store', required=False,
                         choices=["debug", "info", "warning", "error", "critical"],
                         default=DEFAULT_LOG_LEVEL,
@@ -169,7 +390,27 @@ def main():
 
     _get_logger().info("Log level is '%s'", args.log_level.upper())
 
-    process_files(files=args.files, spacing=args.distance)
+    cleaning = clean_options(parser, args)
+
+    selection = selection_options(args)
+
+    spacing = args.distance or DEFAULT_DISTANCE
+    if args.output:
+        # every input and level needs its own file, or they would overwrite each other
+        try:
+            paths = [os.path.abspath(path) for gpx_file in args.files
+                     for path in level_paths(gpx_file, _spacings(spacing), args.output)]
+        except (IndexError, KeyError, ValueError) as err:
+            parser.error("-o/--output '{}' is not a valid pattern: {} {}".format(
+                args.output, type(err).__name__, err))
+        if len(set(paths)) != len(paths):
+            parser.error("-o/--output '{}' must give a different file for every input and "
+                         "distance, use {{name}} and {{distance}}".format(args.output))
+        if set(paths) & set(os.path.abspath(gpx_file.name) for gpx_file in args.files):
+            parser.error("-o/--output '{}' would overwrite an input file".format(args.output))
+
+    process_files(files=args.files, spacing=spacing,
+                  pattern=args.output, cleaning=cleaning, selection=selection)
 
 if __name__ == '__main__':
     main()
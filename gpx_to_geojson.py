@@ -9,20 +9,28 @@ Take a GPX file and output a GeoJSON representation
 #
 from __future__ import print_function
 import argparse
+import concurrent.futures
+import functools
+import itertools
+import json
 import logging
 import os
 import re
+import signal
 import sys
+import tempfile
+import time
 #
-# Non-standard imports
+# Ensure ./lib is in the lib path for local includes
 #
-from geojson import dumps, Feature, FeatureCollection, LineString, MultiLineString, Point
-import gpxpy
-import gpxpy.gpx
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
 #
-# Ensure ./lib is in the lib path for local includes
+# Local imports
 #
-sys.path.append(os.path.realpath(os.path.join('.', 'lib')))
+# pylint: disable=wrong-import-position
+from gpx_batch import batch_paths, pool_worker
+from gpx_clean import add_clean_arguments, clean_events, clean_options
+from gpx_stream import add_selection_arguments, iter_gpx, selection_options
 #
 ##############################################################################
 #
@@ -30,6 +38,7 @@ sys.path.append(os.path.realpath(os.path.join('.', 'lib')))
 #
 DEFAULT_DISTANCE = 0.08
 DEFAULT_LOG_LEVEL = 'warning'
+GEOJSON_PRECISION = 6
 #
 ##############################################################################
 #
@@ -41,46 +50,277 @@ def _get_logger():
 #
 ###############################################################################
 #
+# geojson_chunks()
+#
+def geojson_chunks(events=None, stats=None):
+    '''
+    geojson_chunks(events, stats=None) - Stage turning track events into GeoJSON text
+
+    Produces the same FeatureCollection of MultiLineString features as geojson.dumps()
+    from geojson 3.x, coordinates rounded to GEOJSON_PRECISION decimals, one chunk per
+    batch of points. The number of points is counted into stats['points'].
+    '''
+    stats = stats if stats is not None else {}
+    stats.setdefault('points', 0)
+    debug = _get_logger().isEnabledFor(logging.DEBUG)
+    track_name = None
+    first_track = first_segment = first_point = True
+
+    yield '{"type": "FeatureCollection", "features": ['
+
+    for kind, value in events or []:
+        if kind == 'track':
+            _get_logger().info("Processing track: '%s'", value)
+            track_name = value
+            first_segment = True
+            yield ('' if first_track else ', ') + ('{"type": "Feature", "geometry": '
+                                                   '{"type": "MultiLineString", "coordinates": [')
+            first_track = False
+        elif kind == 'segment':
+            first_point = True
+            yield ('' if first_segment else ', ') + '['
+            first_segment = False
+        elif kind == 'points':
+            if debug:
+                for point in value:
+                    _get_logger().debug('Point at (%f,%f) -> %s', point.latitude,
+                                        point.longitude, point.elevation)
+            stats['points'] += len(value)
+            yield ('' if first_point else ', ') + ', '.join(
+                '[{!r}, {!r}]'.format(round(point.longitude, GEOJSON_PRECISION),
+                                      round(point.latitude, GEOJSON_PRECISION))
+                for point in value)
+            first_point = False
+        elif kind == 'end_segment':
+            yield ']'
+        elif kind == 'end_track':
+            yield ']}, "properties": {"name": ' + json.dumps(track_name) + '}}'
+
+    yield ']}'
+#
+###############################################################################
+#
+# output_path()
+#
+def output_path(gpx_path=None):
+    '''output_path(gpx_path) - The .geojson written for a GPX path, next to it'''
+    return os.path.splitext(gpx_path)[0] + '.geojson'
+#
+###############################################################################
+#
+# process_file()
+#
+def process_file(gpx_file=None, cleaning=None, selection=None):
+    '''
+    process_file(gpx_file=None, cleaning=None, selection=None) - Convert a GPX file
+
+    Returns the number of points written. The file is streamed through read and convert
+    generator stages, so only a batch of points is held at a time. Output goes to a
+    temporary file that only replaces the real one once the conversion has succeeded.
+    cleaning is an optional dict of gpx_clean.clean_events() arguments, selection an
+    optional dict of since, until and bbox arguments for gpx_stream.iter_gpx().
+    '''
+    stats = {'points': 0}
+
+    if None not in [gpx_file]:
+        output_file = output_path(gpx_file.name)
+        _path = os.path.dirname(output_file)
+        if os.path.abspath(output_file) == os.path.abspath(gpx_file.name):
+            raise RuntimeError("Output '{}' would overwrite the input!".format(output_file))
+
+        # Parsing an existing file:
+        _get_logger().info("Processing file: '%s'", gpx_file.name)
+        _get_logger().info("Writing output to: '%s'", output_file)
+
+        events = iter_gpx(gpx_file, **(selection or {}))
+        if cleaning:
+            events = clean_events(events, **cleaning)
+        # a unique temporary name, concurrent workers may be converting into the same directory
+        temp_fd, temp_file = tempfile.mkstemp(dir=_path or None, suffix='.geojson')
+        try:
+            with os.fdopen(temp_fd, 'w', encoding="utf8") as output_handle:
+                for chunk in geojson_chunks(events, stats):
+                    output_handle.write(chunk)
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, output_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    return stats['points']
+#
+###############################################################################
+#
 # process_files()
 #
-def process_files(files=None):
+def process_files(files=None, cleaning=None, selection=None):
     '''
-    process_files(files=[], distance=DEFAULT_DISTANCE)
+    process_files(files=[], cleaning=None)
     '''
 
     if None not in [files]:
         for gpx_file in files:
+            process_file(gpx_file, cleaning, selection)
+#
+###############################################################################
+#
+# _process_path() - batch worker, must stay at module level to be picklable
+#
+@pool_worker
+def _process_path(path, cleaning=None, selection=None):
+    '''_process_path(path, cleaning=None, selection=None) - Convert a single GPX file by path'''
+    with open(path, 'r', encoding="utf8") as gpx_file:
+        return process_file(gpx_file, cleaning, selection)
+#
+###############################################################################
+#
+# read_checkpoint()
+#
+def read_checkpoint(checkpoint=None):
+    '''
+    read_checkpoint(checkpoint=None) - Return the set of paths already completed
+    '''
+    completed = set()
+    if checkpoint and os.path.isfile(checkpoint):
+        with open(checkpoint, 'r', encoding="utf8") as checkpoint_handle:
+            completed = set(line.rstrip('\n') for line in checkpoint_handle if line.strip())
+    return completed
+#
+###############################################################################
+#
+# _ignore_interrupt() - pool initializer, Ctrl-C is handled by the parent only
+#
+def _ignore_interrupt():
+    '''_ignore_interrupt() - Let workers finish their file when Ctrl-C is pressed'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+#
+###############################################################################
+#
+# _record_job()
+#
+def _record_job(job, path, summary, checkpoint_handle):
+    '''_record_job(job, path, summary, checkpoint_handle) - Count and checkpoint a finished job'''
+    try:
+        summary['points'] += job.result()
+    # pylint: disable=broad-except
+    except Exception as err:
+        _get_logger().error("Failed to process '%s': %s", path, err)
+        summary['failed'] += 1
+        summary['failures'].append((path, str(err)))
+        return
 
-            _path = os.path.dirname(gpx_file.name)
-            _file = os.path.basename(gpx_file.name).split('.')[0] + '.geojson'
-            output_file = os.path.sep.join([_path, _file])
+    summary['completed'] += 1
+    if checkpoint_handle:
+        checkpoint_handle.write(path + '\n')
+        checkpoint_handle.flush()
+#
+###############################################################################
+#
+# process_batch()
+#
+def process_batch(paths=None, checkpoint=None, workers=None, cleaning=None, selection=None):
+    '''
+    process_batch(paths=[], checkpoint=None, workers=None, cleaning=None, selection=None)
 
-            tracks = []
+    Convert many GPX files through a process pool. Each completed file is appended
+    to the checkpoint file so a rerun skips it, and a failing file is logged and
+    counted without stopping the rest of the batch. Inputs that would write the same
+    output as an earlier input are counted as failed and not converted. On Ctrl-C no
+    more files are started, the files in progress are finished and checkpointed and
+    the summary is returned with 'interrupted' set. Returns a summary dict.
+    '''
+    summary = {'total': 0, 'skipped': 0, 'completed': 0, 'failed': 0, 'points': 0,
+               'elapsed': 0.0, 'failures': [], 'interrupted': False}
 
-            # Parsing an existing file:
-            _get_logger().info("Processing file: '%s'", gpx_file.name)
-            _get_logger().info("Writing output to: '%s'", output_file)
-            gpx = gpxpy.parse(gpx_file)
+    if None in [paths]:
+        raise RuntimeError("No files to process!")
 
-            for track in gpx.tracks:
-                _get_logger().info("Processing track: '%s'", track.name)
+    # Normalise and de-duplicate while keeping the requested order
+    pending = []
+    seen = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            pending.append(path)
+    summary['total'] = len(pending)
 
-                #properties={"country": "Spain"}
-                segments = []
-                for segment in track.segments:
+    # Two inputs writing one output would race in the pool, keep only the first
+    targets = {}
+    for path in pending:
+        target = output_path(path)
+        if target in targets:
+            error = "Output '{}' is already written by '{}'".format(target, targets[target])
+            _get_logger().error("Skipping '%s': %s", path, error)
+            summary['failed'] += 1
+            summary['failures'].append((path, error))
+        else:
+            targets[target] = path
+    pending = list(targets.values())
 
-                    points = []
-                    for point in segment.points:
-                        _get_logger().debug('Point at (%f,%f) -> %s', point.latitude,
-                                            point.longitude, point.elevation)
-                        points.append(Point((point.longitude, point.latitude)))
+    completed = read_checkpoint(checkpoint)
+    if completed:
+        pending = [path for path in pending if path not in completed]
+        summary['skipped'] = summary['total'] - summary['failed'] - len(pending)
+        _get_logger().info("Skipping '%s' files already in checkpoint '%s'",
+                           summary['skipped'], checkpoint)
 
-                    segments.append(LineString(points))
-                tracks.append(Feature(geometry=MultiLineString(segments),
-                                      properties={"name": track.name}))
+    start = time.time()
+    checkpoint_handle = open(checkpoint, 'a', encoding="utf8") if checkpoint else None
+    # only a couple of jobs per worker are queued, so an interrupt has little to wait for
+    limit = 2 * (workers or os.cpu_count() or 1)
+    queued = iter(pending)
+    jobs = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=_ignore_interrupt) as executor:
+            worker = functools.partial(_process_path, cleaning=cleaning, selection=selection)
+            try:
+                while True:
+                    for path in itertools.islice(queued, limit - len(jobs)):
+                        jobs[executor.submit(worker, path)] = path
+                    if not jobs:
+                        break
+                    done, _ = concurrent.futures.wait(
+                        jobs, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for job in done:
+                        _record_job(job, jobs.pop(job), summary, checkpoint_handle)
+            except KeyboardInterrupt:
+                summary['interrupted'] = True
+                executor.shutdown(wait=False, cancel_futures=True)
+                _get_logger().warning("Interrupted, finishing the '%s' files in progress",
+                                      len([job for job in jobs if not job.cancelled()]))
+                for job in concurrent.futures.as_completed(jobs):
+                    if not job.cancelled():
+                        _record_job(job, jobs[job], summary, checkpoint_handle)
+    finally:
+        if checkpoint_handle:
+            checkpoint_handle.close()
 
-            with open(output_file, 'w', encoding="utf8") as output_handle:
-                output_handle.write(dumps(FeatureCollection(tracks)))
+    summary['elapsed'] = time.time() - start
+    return summary
+#
+###############################################################################
+#
+# print_summary()
+#
+def print_summary(summary=None):
+    '''
+    print_summary(summary=None) - Report throughput and failures of a batch run
+    '''
+    if summary:
+        elapsed = summary['elapsed'] or 1e-9
+        print("Files: {total} total, {completed} completed, {skipped} skipped, "
+              "{failed} failed".format(**summary))
+        print("Throughput: {:.2f} files/s, {:.0f} points/s over {:.1f}s".format(
+            summary['completed'] / elapsed, summary['points'] / elapsed, summary['elapsed']))
+        for path, error in summary['failures']:
+            print("FAILED: {}: {}".format(path, error))
+        if summary['interrupted']:
+            print("INTERRUPTED: {} files not started, rerun to continue".format(
+                summary['total'] - summary['skipped'] - summary['completed'] -
+                summary['failed']))
 #
 ###############################################################################
 #
@@ -96,10 +336,27 @@ def main():
     parser = argparse.ArgumentParser(description='Take an existing GPX file convert it to GeoJSON')
 
     parser.add_argument('-f', '--files', default=[], action='append',
-                        required=True, type=argparse.FileType('r'),
+                        type=argparse.FileType('r'),
                         help='Which GPX file to process. Repeat to '
                         'process multiple files.')
 
+    parser.add_argument('-m', '--manifest', default=None, type=argparse.FileType('r'),
+                        help='Batch mode: file listing one GPX path per line.')
+
+    parser.add_argument('-g', '--glob', default=[], action='append',
+                        help='Batch mode: glob of GPX files to process, "**" recurses. '
+                        'Repeat to add more patterns.')
+
+    parser.add_argument('-c', '--checkpoint', default=None,
+                        help='Batch mode: record completed files here and skip them on rerun.')
+
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help='Batch mode: number of worker processes. Default: CPU count')
+
+    add_selection_arguments(parser)
+
+    add_clean_arguments(parser)
+
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Enable additional output')
 
@@ -110,6 +367,10 @@ def main():
 
     args = parser.parse_args()
 
+    batch_mode = args.manifest or args.glob or args.checkpoint
+    if not (args.files or args.manifest or args.glob):
+        parser.error('one of -f/--files, -m/--manifest or -g/--glob is required')
+
     # Enable the debug level logging when in debug mode
     if args.debug:
         args.log_level = 'debug'
@@ -120,7 +381,25 @@ def main():
 
     _get_logger().info("Log level is '%s'", args.log_level.upper())
 
-    process_files(files=args.files)
+    cleaning = clean_options(parser, args)
+
+    selection = selection_options(args)
+
+    if batch_mode:
+        paths = [gpx_file.name for gpx_file in args.files]
+        for gpx_file in args.files:
+            gpx_file.close()
+        paths = batch_paths(paths, args.manifest, args.glob)
+
+        summary = process_batch(paths=paths, checkpoint=args.checkpoint, workers=args.workers,
+                                cleaning=cleaning, selection=selection)
+        print_summary(summary)
+        if summary['interrupted']:
+            sys.exit(130)
+        if summary['failed']:
+            sys.exit(1)
+    else:
+        process_files(files=args.files, cleaning=cleaning, selection=selection)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Aggregate the points of many GPX files into a density grid
+'''
+#
+# Standard Imports
+#
+from __future__ import print_function
+import argparse
+import collections
+import concurrent.futures
+import decimal
+import functools
+import json
+import logging
+import math
+import os
+import sys
+#
+# Ensure ./lib is in the lib path for local includes
+#
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
+#
+# Local imports
+#
+# pylint: disable=wrong-import-position
+from gpx_batch import batch_paths, describe_error, pool_worker
+from gpx_stream import iter_gpx
+from track_arrays import parse_time
+#
+##############################################################################
+#
+# Global variables
+#
+CHUNK_FILES = 64
+DEFAULT_CELL_SIZE = 0.001
+DEFAULT_FORMAT = 'geojson'
+DEFAULT_LOG_LEVEL = 'warning'
+DEFAULT_MAX_GAP = 60.0
+DEFAULT_WEIGHT = 'count'
+#
+##############################################################################
+#
+# _get_logger() - reusable code to get the correct logger by name
+#
+def _get_logger():
+    '''_get_logger() - reuable code to get the correct logger by name'''
+    return logging.getLogger(os.path.basename(__file__))
+#
+###############################################################################
+#
+# grid_points()
+#
+def grid_points(events=None, cell_size=None, weight=None, max_gap=None, grid=None):
+    '''
+    grid_points(events, cell_size=DEFAULT_CELL_SIZE, weight='count', max_gap=DEFAULT_MAX_GAP)
+
+    Add streamed track events into a {(row, col): value} grid of cell_size degree cells.
+    With weight 'count' every point adds one, with weight 'time' a point adds the seconds
+    until the next point of its segment, ignoring gaps over max_gap seconds. Memory is
+    bounded by the number of occupied cells, not the number of points.
+    '''
+    cell_size = cell_size or DEFAULT_CELL_SIZE
+    weight = weight or DEFAULT_WEIGHT
+    max_gap = max_gap or DEFAULT_MAX_GAP
+    grid = grid if grid is not None else collections.Counter()
+    previous = None
+
+    for kind, value in events or []:
+        if kind == 'segment':
+            previous = None
+        elif kind == 'points':
+            for point in value:
+                cell = (int(math.floor(point.latitude / cell_size)),
+                        int(math.floor(point.longitude / cell_size)))
+                if weight == 'count':
+                    grid[cell] += 1
+                    continue
+
+                # time weighting credits the previous point's cell with the gap to this one
+                seconds = parse_time(point.time)
+                if previous is not None:
+                    gap = seconds - previous[1]
+                    if 0 < gap <= max_gap:
+                        grid[previous[0]] += gap
+                previous = None if math.isnan(seconds) else (cell, seconds)
+
+    return grid
+#
+###############################################################################
+#
+# _grid_paths() - pool worker, must stay at module level to be picklable
+#
+@pool_worker
+def _grid_paths(paths, cell_size=None, weight=None, max_gap=None):
+    '''
+    _grid_paths(paths, ...) - Partial grid over a chunk of GPX files
+
+    Returns (grid, failures), failures is a list of (path, error) for files that could
+    not be read, their points are left out of the grid.
+    '''
+    grid = collections.Counter()
+    failures = []
+    for path in paths:
+        try:
+            # a file failing half way must not leave half its points behind
+            grid.update(grid_points(iter_gpx(path), cell_size, weight, max_gap))
+        # pylint: disable=broad-except
+        except Exception as err:
+            failures.append((path, describe_error(err)))
+    return grid, failures
+#
+###############################################################################
+#
+# process_files()
+#
+def process_files(paths=None, cell_size=None, weight=None, max_gap=None, workers=None):
+    '''
+    process_files(paths=[], cell_size=DEFAULT_CELL_SIZE, weight='count', max_gap=DEFAULT_MAX_GAP,
+                  workers=None)
+
+    Split the files into chunks, grid each chunk into a partial grid in a process pool
+    and merge the partial grids as they complete. Only the merged grid and the partial
+    grids in flight are held, however many files there are. Files that fail to parse
+    are logged and skipped. Returns the merged grid.
+    '''
+
+    if None in [paths]:
+        raise RuntimeError("No files to process!")
+
+    grid = collections.Counter()
+    worker = functools.partial(_grid_paths, cell_size=cell_size, weight=weight, max_gap=max_gap)
+    # several chunks per worker keeps the pool balanced when file sizes differ
+    chunk_size = max(1, min(CHUNK_FILES,
+                            len(paths) // (4 * (workers or os.cpu_count() or 1))))
+    chunks = [paths[start:start + chunk_size] for start in range(0, len(paths), chunk_size)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = dict((executor.submit(worker, chunk), chunk) for chunk in chunks)
+
+        for job in concurrent.futures.as_completed(jobs):
+            # drop the finished future, it would otherwise keep its partial grid alive
+            chunk = jobs.pop(job)
+            try:
+                partial, failures = job.result()
+            # pylint: disable=broad-except
+            except Exception as err:
+                partial, failures = {}, [(path, str(err)) for path in chunk]
+
+            grid.update(partial)
+            for path, error in failures:
+                _get_logger().error("Failed to process '%s': %s", path, error)
+            _get_logger().info("Merged '%s' files, grid has '%s' cells", len(chunk), len(grid))
+
+    return grid
+#
+###############################################################################
+#
+# write_geojson()
+#
+def write_geojson(grid=None, cell_size=None, output=None):
+    '''
+    write_geojson(grid, cell_size, output) - Write occupied cells as GeoJSON polygons
+
+    Corners are rounded to the decimals of cell_size, so 0.001 degree cells give corners
+    such as 18.04 rather than the raw product 18.040000000000003.
+    '''
+    cell_size = cell_size or DEFAULT_CELL_SIZE
+    digits = max(0, -decimal.Decimal(repr(cell_size)).normalize().as_tuple().exponent)
+    output.write('{"type": "FeatureCollection", "features": [')
+    for index, ((row, col), value) in enumerate(sorted((grid or {}).items())):
+        south, west = round(row * cell_size, digits), round(col * cell_size, digits)
+        north, east = round((row + 1) * cell_size, digits), round((col + 1) * cell_size, digits)
+        output.write(('' if index == 0 else ', ') + json.dumps({
+            "type": "Feature",
+            "geometry": {"type": "Polygon",
+                         "coordinates": [[[west, south], [east, south], [east, north],
+                                          [west, north], [west, south]]]},
+            "properties": {"value": value}}))
+    output.write(']}\n')
+#
+###############################################################################
+#
+# write_ascii_grid()
+#
+def write_ascii_grid(grid=None, cell_size=None, output=None):
+    '''
+    write_ascii_grid(grid, cell_size, output) - Write the grid as an ESRI ASCII raster
+
+    The raster covers the bounding box of the occupied cells, empty cells are 0.
+    '''
+    cell_size = cell_size or DEFAULT_CELL_SIZE
+    grid = grid or {}
+    rows = [row for row, _ in grid] or [0]
+    cols = [col for _, col in grid] or [0]
+    min_row, max_row, min_col, max_col = min(rows), max(rows), min(cols), max(cols)
+
+    output.write('ncols {}\nnrows {}\nxllcorner {!r}\nyllcorner {!r}\ncellsize {!r}\n'
+                 'NODATA_value -9999\n'.format(max_col - min_col + 1, max_row - min_row + 1,
+                                               min_col * cell_size, min_row * cell_size,
+                                               cell_size))
+    # rows run north to south
+    for row in range(max_row, min_row - 1, -1):
+        output.write(' '.join('{:g}'.format(grid.get((row, col), 0))
+                              for col in range(min_col, max_col + 1)) + '\n')
+#
+###############################################################################
+#
+# main()
+#
+def main():
+    """
+    Main function to do the work
+    """
+    #
+    # Handle CLI args
+    #
+    parser = argparse.ArgumentParser(description='Aggregate GPX files into a density grid')
+
+    parser.add_argument('-f', '--files', default=[], action='append',
+                        help='Which GPX file to process. Repeat to '
+                        'process multiple files.')
+
+    parser.add_argument('-m', '--manifest', default=None, type=argparse.FileType('r'),
+                        help='File listing one GPX path per line.')
+
+    parser.add_argument('-g', '--glob', default=[], action='append',
+                        help='Glob of GPX files to process, "**" recurses. '
+                        'Repeat to add more patterns.')
+
+    parser.add_argument('-o', '--output', default=None,
+                        help='Where to write the grid. Default: stdout')
+
+    parser.add_argument('--format', default=DEFAULT_FORMAT, choices=['geojson', 'asc'],
+                        help=('GeoJSON polygons per occupied cell, or an ESRI ASCII raster. '
+                              'Default: {}'.format(DEFAULT_FORMAT)))
+
+    parser.add_argument('-s', '--cell-size', default=DEFAULT_CELL_SIZE, type=float,
+                        help='Grid cell size in degrees. Default: {}'.format(DEFAULT_CELL_SIZE))
+
+    parser.add_argument('--weight', default=DEFAULT_WEIGHT, choices=['count', 'time'],
+                        help=('Count points, or sum the seconds spent in each cell. '
+                              'Default: {}'.format(DEFAULT_WEIGHT)))
+
+    parser.add_argument('--max-gap', default=DEFAULT_MAX_GAP, type=float,
+                        help=('With time weighting, ignore gaps between points longer than this '
+                              'many seconds. Default: {}'.format(DEFAULT_MAX_GAP)))
+
+    parser.add_argument('-w', '--workers', default=None, type=int,
+                        help='Number of worker processes. Default: CPU count')
+
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='Enable additional output')
+
+    parser.add_argument('-l', '--log-level', action='store', required=False,
+                        choices=["debug", "info", "warning", "error", "critical"],
+                        default=DEFAULT_LOG_LEVEL,
+                        help='Logging verbosity. Default: {}'.format(DEFAULT_LOG_LEVEL))
+
+    args = parser.parse_args()
+
+    paths = batch_paths(args.files, args.manifest, args.glob)
+    if not paths:
+        parser.error('one of -f/--files, -m/--manifest or -g/--glob is required')
+
+    # Enable the debug level logging when in debug mode
+    if args.debug:
+        args.log_level = 'debug'
+
+    # Configure logging
+    logging.basicConfig(format='%(levelname)s:%(module)s.%(funcName)s:%(message)s',
+                        level=getattr(logging, args.log_level.upper()))
+
+    _get_logger().info("Log level is '%s'", args.log_level.upper())
+
+    grid = process_files(paths=paths, cell_size=args.cell_size, weight=args.weight,
+                         max_gap=args.max_gap, workers=args.workers)
+
+    writer = write_ascii_grid if args.format == 'asc' else write_geojson
+    if args.output:
+        _get_logger().info("Writing output to: '%s'", args.output)
+        with open(args.output, 'w', encoding="utf8") as output_handle:
+            writer(grid, args.cell_size, output_handle)
+    else:
+        writer(grid, args.cell_size, sys.stdout)
+
+if __name__ == '__main__':
+    main()
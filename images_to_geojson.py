@@ -8,6 +8,7 @@ Take a directory of GPS tagged images and produce a GPX track file
 from __future__ import print_function
 import argparse
 import logging
+import math
 import os
 import re
 import sys
@@ -15,17 +16,25 @@ import sys
 # Non-standard imports
 #
 import exifread
-from geojson import dumps, GeometryCollection, LineString, Point
+from geojson import dumps, Feature, FeatureCollection, GeometryCollection, LineString, Point
 #
 # Ensure ./lib is in the lib path for local includes
 #
-sys.path.append(os.path.realpath(os.path.join('.', 'lib')))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
+#
+# Local imports
+#
+# pylint: disable=wrong-import-position
+from gpx_stream import TrackPoint
+from track_arrays import extend_segment, finish_segment, new_segment
 #
 ##############################################################################
 #
 # Global variables
 #
+DEFAULT_CELL_SIZE = 100.0
 DEFAULT_LOG_LEVEL = 'WARNING'
+METRES_PER_DEGREE = 111320.0
 #
 ##############################################################################
 #
@@ -99,50 +108,181 @@ def get_lat_lon_ele(gps_info):
 #
 ###############################################################################
 #
-# process_directory()
+# iter_directory()
 #
-def process_directory(directory=None):
-    '''
-    process_directory(directory=None) - Process all files in the given directory
+def iter_directory(directory=None):
     '''
+    iter_directory(directory=None) - Yield (lat, lon, ele, date) for each geotagged image
 
-    track = []
+    date is the EXIF 'Image DateTime' as an ISO 8601 string, or None if missing.
+    '''
 
     if None in [directory]:
         _get_logger().warning("Missing arguments!")
-    else:
-        for the_file in os.listdir(directory):
-            image_file = os.sep.join([directory, the_file])
+        return
+
+    for the_file in os.listdir(directory):
+        image_file = os.sep.join([directory, the_file])
+
+        _get_logger().info("File is '%s'", image_file)
+        if os.path.isfile(image_file):
+            # Open image file for reading (binary mode) and return Exif tags
+            with open(image_file, 'rb') as file_handle:
+                tags = exifread.process_file(file_handle, details=False)
+
+            gps_info = {}
+            date = None
+
+            for tag, value in tags.items():
 
-            _get_logger().info("File is '%s'", image_file)
-            if os.path.isfile(image_file):
-                # Open image file for reading (binary mode)
-                file_handle = open(image_file, 'rb')
+                if re.search('^GPS', tag):
+                    _get_logger().debug("Tag: '%s'", tag)
+                    split = tag.split(' ')
+                    key = split[1]
+                    _get_logger().debug("Key: '%s', value '%s'", key, value)
+                    gps_info[key] = tags[tag].values
 
-                # Return Exif tags
-                try:
-                    tags = exifread.process_file(file_handle, details=False)
-                except (Exception) as err:
-                    raise err
+                if tag == 'Image DateTime':
+                    # '2015:10:20 14:23:01' -> '2015-10-20T14:23:01'
+                    date = str(value.values).replace(':', '-', 2).replace(' ', 'T', 1)
+
+            (lat, lon, ele) = get_lat_lon_ele(gps_info)
+
+            if lat and lon:
+                yield lat, lon, ele, date
+#
+###############################################################################
+#
+# read_directory()
+#
+def read_directory(directory=None, use_numpy=None):
+    '''
+    read_directory(directory=None, use_numpy=None) - Library form of process_directory()
+
+    Returns a track_arrays.Segment of latitude, longitude, elevation and time arrays
+    (numpy views when NumPy is available) in directory listing order. Times are the
+    camera's local 'Image DateTime' taken as UTC.
+    '''
+    segment = new_segment()
+    extend_segment(segment, (TrackPoint(lat, lon, ele, date, None)
+                             for (lat, lon, ele, date) in iter_directory(directory)))
+    return finish_segment(segment, use_numpy)
+#
+###############################################################################
+#
+# process_directory()
+#
+def process_directory(directory=None):
+    '''
+    process_directory(directory=None) - Process all files in the given directory
+    '''
 
-                gps_info = {}
+    segment = read_directory(directory, use_numpy=False)
 
-                for tag, value in tags.items():
+    return LineString(list(zip(segment.longitude, segment.latitude)))
+#
+###############################################################################
+#
+# _grid_cell()
+#
+def _row_scale(row, size):
+    '''_row_scale(row, size) - Column scale of a grid row, cos() of its centre latitude'''
+    return max(math.cos(math.radians((row + 0.5) * size)), 1e-6)
 
-                    if re.search('^GPS', tag):
-                        _get_logger().debug("Tag: '%s'", tag)
-                        split = tag.split(' ')
-                        key = split[1]
-                        _get_logger().debug("Key: '%s', value '%s'", key, value)
-                        gps_info[key] = tags[tag].values
+def _grid_cell(lat, lon, cell_size):
+    '''
+    _grid_cell(lat, lon, cell_size) - (row, col) of the ~cell_size metre square holding a point
 
-                # pylint: disable=unused-variable
-                (lat, lon, ele) = get_lat_lon_ele(gps_info)
+    Columns shrink towards the poles so cells stay roughly square on the ground, each row
+    has its own scale, so a column number only means the same longitude within a row.
+    '''
+    size = cell_size / METRES_PER_DEGREE
+    row = int(math.floor(lat / size))
+    return row, int(math.floor(lon * _row_scale(row, size) / size))
+#
+###############################################################################
+#
+# _find()
+#
+def _find(parents, cell):
+    '''_find(parents, cell) - Union-find root of a grid cell, with path halving'''
+    while parents[cell] != cell:
+        parents[cell] = parents[parents[cell]]
+        cell = parents[cell]
+    return cell
+#
+###############################################################################
+#
+# cluster_points()
+#
+def cluster_points(points=None, cell_size=None):
+    '''
+    cluster_points(points, cell_size=DEFAULT_CELL_SIZE) - Aggregate photo positions into clusters
 
-                if lat and lon:
-                    track.append(Point((lon, lat)))
+    points is an iterable of (lat, lon, ele, date) as produced by iter_directory(). Points
+    are first hashed into a grid of cell_size metre cells, keeping only a running count,
+    coordinate sums and first/last date per cell, then neighbouring cells whose centres
+    are closer than cell_size are merged. Time is linear in the number of points and
+    memory linear in the number of occupied cells.
 
-    return LineString(track)
+    Returns a FeatureCollection of Points with 'count', 'first' and 'last' properties.
+    '''
+    cell_size = cell_size or DEFAULT_CELL_SIZE
+    cells = {}
+
+    # pylint: disable=unused-variable
+    for (lat, lon, ele, date) in points or []:
+        cell = _grid_cell(lat, lon, cell_size)
+        stats = cells.get(cell)
+        if stats is None:
+            stats = cells[cell] = [0, 0.0, 0.0, date, date]
+        stats[0] += 1
+        stats[1] += lat
+        stats[2] += lon
+        if date:
+            stats[3] = min(stats[3] or date, date)
+            stats[4] = max(stats[4] or date, date)
+
+    _get_logger().info("Hashed points into '%s' grid cells", len(cells))
+
+    # Merge neighbouring cells whose centres are close enough. Rows are scaled differently,
+    # so the columns next to a cell in the row above are found from its longitude.
+    size = cell_size / METRES_PER_DEGREE
+    parents = dict((cell, cell) for cell in cells)
+    for (row, col), stats in cells.items():
+        lat, lon = stats[1] / stats[0], stats[2] / stats[0]
+        above = int(math.floor(lon * _row_scale(row + 1, size) / size))
+        for neighbour in [(row, col + 1), (row + 1, above - 1), (row + 1, above),
+                          (row + 1, above + 1)]:
+            other = cells.get(neighbour)
+            if other is None:
+                continue
+            d_lat = (other[1] / other[0] - lat) * METRES_PER_DEGREE
+            d_lon = (other[2] / other[0] - lon) * METRES_PER_DEGREE * math.cos(math.radians(lat))
+            if math.hypot(d_lat, d_lon) < cell_size:
+                parents[_find(parents, neighbour)] = _find(parents, (row, col))
+
+    clusters = {}
+    for cell, stats in cells.items():
+        root = _find(parents, cell)
+        cluster = clusters.get(root)
+        if cluster is None:
+            clusters[root] = list(stats)
+        else:
+            cluster[0] += stats[0]
+            cluster[1] += stats[1]
+            cluster[2] += stats[2]
+            cluster[3] = min([date for date in [cluster[3], stats[3]] if date] or [None])
+            cluster[4] = max([date for date in [cluster[4], stats[4]] if date] or [None])
+
+    _get_logger().info("Merged grid cells into '%s' clusters", len(clusters))
+
+    features = []
+    for (count, lat_sum, lon_sum, first, last) in clusters.values():
+        features.append(Feature(geometry=Point((lon_sum / count, lat_sum / count)),
+                                properties={"count": count, "first": first, "last": last}))
+
+    return FeatureCollection(features)
 #
 ###############################################################################
 #
@@ -178,6 +318,12 @@ def main():
                         help='Which directory of images to process. Repeat to '
                         'process multiple directories.')
 
+    parser.add_argument('-c', '--cluster', default=None, const=DEFAULT_CELL_SIZE, nargs='?',
+                        type=float, metavar='METRES',
+                        help=('Output a FeatureCollection of photo clusters instead of a '
+                              'LineString, merging photos within METRES. '
+                              'Default: {}'.format(DEFAULT_CELL_SIZE)))
+
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Enable additional output')
 
@@ -198,6 +344,11 @@ def main():
 
     _get_logger().info("Log level is '%s'", args.log_level.upper())
 
+    if args.cluster:
+        points = (point for directory in args.directory for point in iter_directory(directory))
+        print(dumps(cluster_points(points, cell_size=args.cluster)))
+        return
+
     tracks = []
 
     for directory in args.directory:
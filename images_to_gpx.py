@@ -7,21 +7,43 @@ Take a directory of GPS tagged images and produce a GPX track file
 #
 from __future__ import print_function
 import argparse
+import heapq
 import logging
 import os
+import pickle
 import re
-import time
+import sys
+import tempfile
 #
 # Non-standard imports
 #
 import exifread
-import gpxpy.gpx
+#
+# Ensure ./lib is in the lib path for local includes
+#
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
+#
+# Local imports
+#
+# pylint: disable=wrong-import-position
+from gpx_stream import DEFAULT_BATCH_SIZE, TrackPoint, gpx_chunks
 #
 ##############################################################################
 #
 # Global variables
 #
 DEFAULT_LOG_LEVEL = 'WARNING'
+DEFAULT_RUN_SIZE = 250000
+GPX_ATTRIBUTES = {
+    '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation':
+        'http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd',
+    'version': '1.0',
+    'creator': 'images_to_gpx.py',
+}
+GPX_NAMESPACES = {
+    'http://www.w3.org/2001/XMLSchema-instance': 'xsi',
+    'http://www.topografix.com/GPX/1/0': '',
+}
 #
 ##############################################################################
 #
@@ -55,22 +77,6 @@ def _convert_to_degress(value):
 #
 ###############################################################################
 #
-# clean_output()
-#
-def clean_output(output=None):
-    '''
-    clean_output(output=None) - Remove extra EOLs from gpx.to_xml()
-    '''
-    if output:
-        # remove some superfluous EOLs
-        point_pattern = re.compile(r'^(<trkpt [^>]*>)\n', re.MULTILINE)
-        elevation_pattern = re.compile(r'^(.*</ele>)\n', re.MULTILINE)
-        output = point_pattern.sub(r"\1", output)
-        output = elevation_pattern.sub(r"\1", output)
-    return output
-#
-###############################################################################
-#
 # get_lat_lon_ele()
 #
 # Implementation from: https://gist.github.com/erans/983821
@@ -105,37 +111,42 @@ def get_lat_lon_ele(gps_info):
 #
 ###############################################################################
 #
-# process_directory()
+# _subsec()
+#
+def _subsec(value=None):
+    '''_subsec(value=None) - EXIF SubSecTime digits ('045') as a fraction of a second'''
+    value = str(value or '').strip()
+    return float('0.' + value) if value.isdigit() else 0.0
 #
-def process_directory(directory=None):
+###############################################################################
+#
+# iter_directory()
+#
+def iter_directory(directory=None):
     '''
-    process_directory(directory=None)
+    iter_directory(directory=None)
 
-    Process all files in the given directory
+    Yield a sortable (undated, date, subsec, filename, lat, lon, ele) record for every
+    geotagged image. Photos sharing a second are ordered by their EXIF sub-second time
+    and then by filename, photos without a date sort last.
     '''
 
-    track = {}
-
     if None in [directory]:
         _get_logger().warning("Missing arguments!")
-        return track
+        return
 
     for the_file in os.listdir(directory):
         image_file = os.sep.join([directory, the_file])
 
         _get_logger().info("File is '%s'", image_file)
         if os.path.isfile(image_file):
-            # Open image file for reading (binary mode)
-            file_handle = open(image_file, 'rb')
-
-            # Return Exif tags
-            try:
+            # Open image file for reading (binary mode) and return Exif tags
+            with open(image_file, 'rb') as file_handle:
                 tags = exifread.process_file(file_handle, details=False)
-            except (Exception) as err:
-                raise err
 
             gps_info = {}
             date = None
+            subsec = 0.0
 
             for tag in tags:
                 if re.search('^GPS', tag):
@@ -147,14 +158,111 @@ def process_directory(directory=None):
 
                 if tag == 'Image DateTime':
                     _get_logger().debug("Key: '%s', value '%s'", tag, tags[tag])
-                    #pprint(tags[tag])
-                    date = time.strptime(tags[tag].values, '%Y:%m:%d %H:%M:%S')
+                    # 'YYYY:MM:DD HH:MM:SS' sorts correctly as text
+                    date = str(tags[tag].values).strip()
+
+                if tag in ['EXIF SubSecTimeOriginal', 'EXIF SubSecTime'] and not subsec:
+                    subsec = _subsec(tags[tag].values)
 
             (lat, lon, ele) = get_lat_lon_ele(gps_info)
 
             if None not in [lat, lon, ele]:
-                track[time.mktime(date)] = gpxpy.gpx.GPXTrackPoint(lat, lon, elevation=ele)
-    return track
+                yield (date is None, date or '', subsec, the_file, lat, lon, ele)
+#
+###############################################################################
+#
+# _spill()
+#
+def _spill(run=None):
+    '''_spill(run) - Write a sorted run to an anonymous temporary file, returns a reader'''
+    spill = tempfile.TemporaryFile()
+    for record in run or []:
+        pickle.dump(record, spill, pickle.HIGHEST_PROTOCOL)
+    spill.seek(0)
+    _get_logger().info("Spilled run of '%s' photos to disk", len(run or []))
+
+    def _read():
+        try:
+            while True:
+                yield pickle.load(spill)
+        except EOFError:
+            return
+        finally:
+            spill.close()
+
+    return _read()
+#
+###############################################################################
+#
+# sort_records()
+#
+def sort_records(records=None, run_size=None):
+    '''
+    sort_records(records, run_size=DEFAULT_RUN_SIZE) - Iterate records in sorted order
+
+    At most run_size records are held in memory. Each full run is sorted and spilled to
+    a temporary file, and the runs are then combined with a k-way heap merge.
+    '''
+    run_size = run_size or DEFAULT_RUN_SIZE
+    runs = []
+    run = []
+
+    for record in records or []:
+        run.append(record)
+        if len(run) >= run_size:
+            run.sort()
+            runs.append(_spill(run))
+            run = []
+
+    run.sort()
+    if not runs:
+        return iter(run)
+
+    runs.append(iter(run))
+    return heapq.merge(*runs)
+#
+###############################################################################
+#
+# process_directory()
+#
+def process_directory(directory=None, run_size=None):
+    '''
+    process_directory(directory=None, run_size=DEFAULT_RUN_SIZE)
+
+    Yield a TrackPoint for every geotagged image in the given directory, in time order
+    '''
+
+    # pylint: disable=unused-variable
+    for (undated, date, subsec, the_file, lat, lon, ele) in sort_records(
+            iter_directory(directory), run_size):
+        yield TrackPoint(lat, lon, ele, None, None)
+#
+###############################################################################
+#
+# track_events()
+#
+def track_events(directories=None, run_size=None, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    track_events(directories=[], run_size=DEFAULT_RUN_SIZE) - Track events for gpx_chunks()
+
+    One track with a segment per directory.
+    '''
+    yield 'gpx', (GPX_ATTRIBUTES, GPX_NAMESPACES)
+    yield 'track', None
+
+    for directory in directories or []:
+        yield 'segment', None
+        batch = []
+        for point in process_directory(directory, run_size):
+            batch.append(point)
+            if len(batch) >= batch_size:
+                yield 'points', batch
+                batch = []
+        if batch:
+            yield 'points', batch
+        yield 'end_segment', None
+
+    yield 'end_track', None
 #
 ###############################################################################
 #
@@ -190,6 +298,10 @@ def main():
                         help='Which directory of images to process. Repeat to '
                         'process multiple directories.')
 
+    parser.add_argument('-r', '--run-size', default=DEFAULT_RUN_SIZE, type=int,
+                        help=('Photos to sort in memory before spilling a sorted run to disk. '
+                              'Default: {}'.format(DEFAULT_RUN_SIZE)))
+
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Enable additional output')
 
@@ -210,24 +322,8 @@ def main():
 
     _get_logger().info("Log level is '%s'", args.log_level.upper())
 
-    gpx = gpxpy.gpx.GPX()
-    # Create first track in our GPX:
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx.tracks.append(gpx_track)
-
-    for directory in args.directory:
-        # Create a segment in our GPX track:
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-
-        track = process_directory(directory)
-
-        for track_time in sorted(track):
-            #pprint(track[track_time])
-            gpx_segment.points.append(track[track_time])
-
-    #pprint(track)
-    print(clean_output(gpx.to_xml()))
+    for chunk in gpx_chunks(track_events(args.directory, args.run_size)):
+        sys.stdout.write(chunk)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Shared helpers for scripts that process many GPX files in a process pool
+'''
+#
+# Standard Imports
+#
+import functools
+import glob
+#
+##############################################################################
+#
+# read_manifest()
+#
+def read_manifest(manifest=None):
+    '''
+    read_manifest(manifest=None) - Return the GPX paths listed in an open manifest file
+
+    One path per line, blank lines and lines starting with '#' are ignored.
+    '''
+    paths = []
+    if None not in [manifest]:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                paths.append(line)
+    return paths
+#
+###############################################################################
+#
+# batch_paths()
+#
+def batch_paths(paths=None, manifest=None, patterns=None):
+    '''
+    batch_paths(paths=[], manifest=None, patterns=[]) - Every GPX path to process
+
+    paths as given, then those listed in the manifest, then the sorted matches of each
+    glob pattern, where "**" recurses.
+    '''
+    paths = list(paths or []) + read_manifest(manifest)
+    for pattern in patterns or []:
+        paths.extend(sorted(glob.glob(pattern, recursive=True)))
+    return paths
+#
+###############################################################################
+#
+# describe_error()
+#
+def describe_error(err=None):
+    '''describe_error(err) - 'ExceptionType: message' for logs and summaries'''
+    return "{}: {}".format(type(err).__name__, err)
+#
+###############################################################################
+#
+# pool_worker()
+#
+def pool_worker(function):
+    '''
+    pool_worker(function) - Decorator for process pool workers
+
+    Some parser exceptions can not be unpickled in the parent, which breaks the whole
+    pool, so any exception is re-raised as a RuntimeError carrying describe_error().
+    The decorated function must be defined at module level to stay picklable.
+    '''
+    @functools.wraps(function)
+    def worker(*args, **kwargs):
+        '''worker(*args, **kwargs) - function() with picklable exceptions'''
+        try:
+            return function(*args, **kwargs)
+        # pylint: disable=broad-except
+        except Exception as err:
+            raise RuntimeError(describe_error(err))
+    return worker
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Remove GPS spikes and smooth jitter with bulk array operations over track segments
+'''
+#
+# Standard Imports
+#
+import argparse
+import logging
+import os
+import warnings
+#
+# Optional imports
+#
+try:
+    import numpy
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    numpy = None
+#
+# Local imports
+#
+from track_arrays import NAN, Segment, parse_time
+#
+##############################################################################
+#
+# Global variables
+#
+DEFAULT_CHUNK_SIZE = 10000
+MAX_PASSES = 5
+METRES_PER_DEGREE = 111320.0
+#
+##############################################################################
+#
+# _get_logger() - reusable code to get the correct logger by name
+#
+def _get_logger():
+    '''_get_logger() - reuable code to get the correct logger by name'''
+    return logging.getLogger(os.path.basename(__file__))
+#
+###############################################################################
+#
+# _require_numpy()
+#
+def _require_numpy():
+    '''_require_numpy() - Cleaning is array based and needs NumPy'''
+    if numpy is None:
+        raise RuntimeError("NumPy is required to clean tracks, pip install numpy")
+#
+###############################################################################
+#
+# smooth_argument() / add_clean_arguments() / clean_options() - the shared cleaning CLI options
+#
+def smooth_argument(argument):
+    '''smooth_argument(argument) - Median window, an odd number of points of at least 3'''
+    try:
+        window = int(argument)
+    except ValueError:
+        window = 0
+    if window < 3 or not window % 2:
+        raise argparse.ArgumentTypeError("{} is not an odd number of at least 3".format(argument))
+    return window
+
+def add_clean_arguments(parser):
+    '''add_clean_arguments(parser) - Add --max-speed, --max-accel and --smooth to an argparser'''
+    parser.add_argument('--max-speed', default=None, type=float,
+                        help='Clean: drop spikes reached and left faster than this many m/s.')
+
+    parser.add_argument('--max-accel', default=None, type=float,
+                        help='Clean: drop spikes needing more than this many m/s^2.')
+
+    parser.add_argument('--smooth', default=None, type=smooth_argument, metavar='POINTS',
+                        help=('Clean: median smooth position and elevation over POINTS points, '
+                              'an odd number of at least 3.'))
+
+def clean_options(parser, args):
+    '''
+    clean_options(parser, args) - clean_events() arguments from parsed CLI args, or None
+
+    Cleaning needs NumPy, without it asking for cleaning is a usage error.
+    '''
+    if args.max_speed or args.max_accel or args.smooth:
+        if numpy is None:
+            parser.error('--max-speed, --max-accel and --smooth need NumPy, pip install numpy')
+        return {'max_speed': args.max_speed, 'max_accel': args.max_accel,
+                'window': args.smooth}
+    return None
+#
+###############################################################################
+#
+# outlier_mask()
+#
+def outlier_mask(latitude=None, longitude=None, time=None, max_speed=None, max_accel=None,
+                 fixed=0):
+    '''
+    outlier_mask(latitude, longitude, time, max_speed=None, max_accel=None, fixed=0)
+
+    Boolean numpy array, True for points to keep. A point is rejected when both the leg
+    into it and the leg out of it are faster than max_speed (m/s), or when the change in
+    velocity at it is above max_accel (m/s^2) and larger than at either neighbour. The
+    test is repeated on the surviving points, as removing a spike can expose the next.
+    The first fixed points are always kept. Points without a time are never rejected.
+    '''
+    _require_numpy()
+    latitude, longitude, time = [numpy.asarray(values, dtype=numpy.float64)
+                                 for values in [latitude, longitude, time]]
+    keep = numpy.ones(len(latitude), dtype=bool)
+    if not (max_speed or max_accel):
+        return keep
+
+    for _ in range(MAX_PASSES):
+        index = numpy.flatnonzero(keep)
+        if len(index) < 3:
+            break
+
+        lat = latitude[index]
+        # metres along each leg, on a local flat approximation
+        d_y = numpy.diff(lat) * METRES_PER_DEGREE
+        d_x = (numpy.diff(longitude[index]) * METRES_PER_DEGREE *
+               numpy.cos(numpy.radians(lat[:-1])))
+        d_t = numpy.diff(time[index])
+
+        bad = numpy.zeros(len(index), dtype=bool)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            v_x, v_y = d_x / d_t, d_y / d_t
+            if max_speed:
+                speed = numpy.hypot(v_x, v_y)
+                bad[1:-1] |= (speed[:-1] > max_speed) & (speed[1:] > max_speed)
+            if max_accel:
+                accel = (numpy.hypot(numpy.diff(v_x), numpy.diff(v_y)) /
+                         ((d_t[:-1] + d_t[1:]) / 2.0))
+                accel = numpy.where(numpy.isnan(accel), 0.0, accel)
+                padded = numpy.concatenate([[-numpy.inf], accel, [-numpy.inf]])
+                bad[1:-1] |= ((accel > max_accel) & (accel >= padded[:-2]) &
+                              (accel >= padded[2:]))
+
+        bad[:numpy.searchsorted(index, fixed)] = False
+        if not bad.any():
+            break
+        keep[index[bad]] = False
+
+    return keep
+#
+###############################################################################
+#
+# median_smooth()
+#
+def median_smooth(values=None, window=None):
+    '''
+    median_smooth(values, window) - Running median over an odd window, ignoring NaN
+
+    Ends are padded with their edge values so the result has the same length.
+    '''
+    _require_numpy()
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if not window or window < 3 or len(values) < 2:
+        return values
+
+    half = window // 2
+    windows = sliding_window_view(numpy.pad(values, half, mode='edge'), 2 * half + 1)
+    if not numpy.isnan(values).any():
+        return numpy.median(windows, axis=1)
+
+    # all-NaN windows (e.g. no elevation at all) stay NaN without a warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return numpy.nanmedian(windows, axis=1)
+#
+###############################################################################
+#
+# clean_segment()
+#
+def clean_segment(segment=None, max_speed=None, max_accel=None, window=None):
+    '''
+    clean_segment(segment, max_speed=None, max_accel=None, window=None) - Clean a Segment
+
+    Library form for track_arrays.Segment: drops outliers, then median smooths position
+    and elevation over window points. Returns a new Segment of numpy arrays.
+    '''
+    _require_numpy()
+    keep = outlier_mask(segment.latitude, segment.longitude, segment.time, max_speed,
+                        max_accel)
+    return Segment(*[median_smooth(numpy.asarray(column)[keep], window)
+                     if name != 'time' else numpy.asarray(column)[keep]
+                     for name, column in zip(Segment._fields, segment)])
+#
+###############################################################################
+#
+# _seconds()
+#
+def _seconds(texts):
+    '''
+    _seconds(texts) - Raw ISO 8601 time texts as a numpy array of seconds since the epoch
+
+    Plain UTC times are converted by numpy in one call, anything else (offsets, missing
+    times) falls back to parse_time() for every text.
+    '''
+    try:
+        stamps = [text[:-1] if text[-1] == 'Z' else text for text in texts]
+        # numpy would warn about and convert offsets, parse_time() handles them
+        if any(stamp.count('-') != 2 or '+' in stamp for stamp in stamps):
+            raise ValueError("time offsets")
+        return (numpy.array(stamps, dtype='datetime64[ms]').astype(numpy.int64) /
+                1000.0)
+    except (IndexError, TypeError, ValueError):
+        return numpy.array([parse_time(text) for text in texts], dtype=numpy.float64)
+#
+###############################################################################
+#
+# _columns()
+#
+def _columns(points):
+    '''_columns(points) - [latitude, longitude, elevation, time] arrays of TrackPoints'''
+    count = len(points)
+    return [numpy.fromiter((point.latitude for point in points), numpy.float64, count),
+            numpy.fromiter((point.longitude for point in points), numpy.float64, count),
+            numpy.fromiter((NAN if point.elevation is None else point.elevation
+                            for point in points), numpy.float64, count),
+            _seconds([point.time for point in points])]
+#
+###############################################################################
+#
+# _clean_chunk()
+#
+def _clean_chunk(context, pending, columns, options, final):
+    '''
+    _clean_chunk(context, pending, columns, options, final) - Clean pending points
+
+    context holds the raw [latitude, longitude, elevation, time] arrays of the already
+    emitted points kept for the window, pending the points not emitted yet and columns
+    their arrays. Unless final, the last margin points are held back as their right hand
+    neighbours are not known yet. Returns (points to emit, new context, points still
+    pending, their columns).
+    '''
+    max_speed, max_accel, window = options
+    margin = max(window or 0, 3)
+    fixed = len(context[0])
+    latitude, longitude, elevation, time = [numpy.concatenate([before, after]) for
+                                            before, after in zip(context, columns)]
+    total = len(latitude)
+    if not total:
+        return [], context, [], columns
+
+    keep = outlier_mask(latitude, longitude, time, max_speed, max_accel, fixed=fixed)
+    decided = total if final else max(total - margin, fixed)
+    accepted = numpy.flatnonzero(keep)
+    emitted = accepted[(accepted >= fixed) & (accepted < decided)]
+
+    if window:
+        # smoothed values only go into the TrackPoints, writers apply them to any element
+        positions = numpy.searchsorted(accepted, emitted)
+        smoothed = [median_smooth(column[accepted], window)[positions].tolist()
+                    for column in [latitude, longitude, elevation]]
+        ready = []
+        for index, lat, lon, ele in zip((emitted - fixed).tolist(), *smoothed):
+            point = pending[index]
+            ready.append(point._replace(latitude=lat, longitude=lon,
+                                        elevation=None if point.elevation is None else ele))
+    else:
+        ready = [pending[index] for index in (emitted - fixed).tolist()]
+
+    rejected = decided - fixed - len(emitted)
+    if rejected:
+        _get_logger().info("Rejected '%s' outlying points", rejected)
+
+    # raw values, smoothing must keep working from the original positions
+    kept = accepted[accepted < decided][-margin:]
+    context = [column[kept] for column in [latitude, longitude, elevation, time]]
+    columns = [column[decided:] for column in [latitude, longitude, elevation, time]]
+    return ready, context, pending[decided - fixed:], columns
+#
+###############################################################################
+#
+# clean_events()
+#
+def clean_events(events=None, max_speed=None, max_accel=None, window=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    clean_events(events, max_speed=None, max_accel=None, window=None) - Stream stage
+
+    Applies outlier rejection and median smoothing to each segment of streamed track
+    events. Every batch of points is turned into coordinate and time arrays once, and
+    segments are processed in chunks of chunk_size points that overlap by the smoothing
+    window, so long segments are not held in memory. Smoothed positions are carried in
+    the TrackPoints, the raw elements are left untouched.
+    '''
+    _require_numpy()
+    options = (max_speed, max_accel, window)
+    empty = [numpy.empty(0) for _ in range(4)]
+    # the arrays of pending points, as one part per batch joined once per chunk
+    context, pending, parts = empty, [], [empty]
+
+    for kind, value in events or []:
+        if kind == 'segment':
+            context, pending, parts = empty, [], [empty]
+        elif kind == 'points':
+            pending.extend(value)
+            parts.append(_columns(value))
+            if len(pending) >= chunk_size:
+                columns = [numpy.concatenate(column) for column in zip(*parts)]
+                ready, context, pending, columns = _clean_chunk(context, pending, columns,
+                                                                options, False)
+                parts = [columns]
+                if ready:
+                    yield 'points', ready
+            continue
+        elif kind == 'end_segment':
+            columns = [numpy.concatenate(column) for column in zip(*parts)]
+            ready, context, pending, columns = _clean_chunk(context, pending, columns,
+                                                            options, True)
+            parts = [columns]
+            if ready:
+                yield 'points', ready
+        yield kind, value
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Stream GPX files as batches of points through generator stages
+'''
+#
+# Standard Imports
+#
+import argparse
+import calendar
+import collections
+import logging
+import math
+import os
+import re
+import time
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+#
+##############################################################################
+#
+# Global variables
+#
+DEFAULT_BATCH_SIZE = 1000
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+GPX_FOOTER = '</gpx>\n'
+NAN = float('nan')
+#
+# A single track point. 'time' is the raw ISO 8601 text from the file and 'element' is
+# the parsed <trkpt> (or None) so writers can reproduce extensions untouched.
+#
+TrackPoint = collections.namedtuple('TrackPoint',
+                                    ['latitude', 'longitude', 'elevation', 'time', 'element'])
+#
+# Events produced by iter_gpx() and consumed by the stages and writers:
+#
+#   ('gpx', (attrib, namespaces))  - root element attributes and {uri: prefix} declarations
+#   ('track', name)                - start of a track, name may be None
+#   ('segment', None)              - start of a track segment
+#   ('points', [TrackPoint, ...])  - a batch of points from the current segment
+#   ('end_segment', None)
+#   ('end_track', None)
+#
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+_TIME_PATTERN = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?'
+                           r'(Z|[+-]\d\d:?\d\d)?$')
+#
+##############################################################################
+#
+# _get_logger() - reusable code to get the correct logger by name
+#
+def _get_logger():
+    '''_get_logger() - reuable code to get the correct logger by name'''
+    return logging.getLogger(os.path.basename(__file__))
+#
+###############################################################################
+#
+# parse_time()
+#
+def parse_time(text=None):
+    '''
+    parse_time(text) - ISO 8601 text ('2016-06-16T07:43:03Z') as seconds since the epoch
+
+    Times without an offset are taken as UTC. Returns NaN for missing or unparsable text.
+    '''
+    match = _TIME_PATTERN.match(text.strip()) if text else None
+    if not match:
+        return NAN
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute),
+                               int(second), 0, 0, 0))
+    if fraction:
+        seconds += float(fraction)
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        sign = -1 if offset[0] == '-' else 1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return float(seconds)
+#
+###############################################################################
+#
+# since_argument() / until_argument() / bbox_argument() - argparse types for the selection
+#
+def _time_argument(argument, day_end):
+    '''_time_argument(argument, day_end) - ISO 8601 date or time as seconds since the epoch'''
+    date_only = len(argument) == 10
+    seconds = parse_time(argument + 'T00:00:00' if date_only else argument)
+    if math.isnan(seconds):
+        raise argparse.ArgumentTypeError("{} is not an ISO 8601 date or time".format(argument))
+    if date_only and day_end:
+        # just before the next midnight, so fractional seconds of the last one still count
+        seconds += 86400 - 1e-6
+    return seconds
+
+def since_argument(argument):
+    '''since_argument(argument) - Start of a window, a date means its first moment'''
+    return _time_argument(argument, False)
+
+def until_argument(argument):
+    '''until_argument(argument) - End of a window, a date means its last moment'''
+    return _time_argument(argument, True)
+
+def bbox_argument(argument):
+    '''bbox_argument(argument) - 'WEST,SOUTH,EAST,NORTH' in degrees as a tuple of floats'''
+    try:
+        bbox = tuple(float(value) for value in argument.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4 or bbox[1] > bbox[3]:
+        raise argparse.ArgumentTypeError("{} is not WEST,SOUTH,EAST,NORTH".format(argument))
+    return bbox
+#
+###############################################################################
+#
+# add_selection_arguments() / selection_options() - the shared selection CLI options
+#
+def add_selection_arguments(parser):
+    '''add_selection_arguments(parser) - Add --since, --until and --bbox to an argparser'''
+    parser.add_argument('--since', default=None, type=since_argument,
+                        help=('Only keep points at or after this ISO 8601 date or time (UTC). '
+                              'A date means the start of that day.'))
+
+    parser.add_argument('--until', default=None, type=until_argument,
+                        help=('Only keep points at or before this ISO 8601 date or time (UTC). '
+                              'A date means the end of that day.'))
+
+    parser.add_argument('--bbox', default=None, type=bbox_argument,
+                        metavar='WEST,SOUTH,EAST,NORTH',
+                        help='Only keep points inside this bounding box, in degrees.')
+
+def selection_options(args):
+    '''selection_options(args) - iter_gpx() selection arguments from parsed CLI args, or None'''
+    if args.since is not None or args.until is not None or args.bbox:
+        return {'since': args.since, 'until': args.until, 'bbox': args.bbox}
+    return None
+#
+###############################################################################
+#
+# _local_name()
+#
+def _local_name(tag):
+    '''_local_name(tag) - Strip any '{namespace}' from an ElementTree tag'''
+    return tag.rsplit('}', 1)[-1]
+#
+###############################################################################
+#
+# _child_text()
+#
+def _child_text(element, name):
+    '''_child_text(element, name) - Text of the first child with the given local name'''
+    for child in element:
+        if _local_name(child.tag) == name:
+            return (child.text or '').strip() or None
+    return None
+#
+###############################################################################
+#
+# _time_window()
+#
+def _time_window(since=None, until=None):
+    '''
+    _time_window(since, until) - Predicate on raw <time> text, or None for no window
+
+    since and until are inclusive seconds since the epoch, either may be None. Plain
+    'YYYY-MM-DDTHH:MM:SS[Z]' text is compared as a string against the bounds written the
+    same way, anything else is parsed. Points without a time are outside any window.
+    '''
+    if since is None and until is None:
+        return None
+
+    # whole second text is inside [since, until] iff it is inside [ceil(since), floor(until)]
+    low = time.strftime(_TIME_FORMAT, time.gmtime(math.ceil(since))) if since is not None else ''
+    high = (time.strftime(_TIME_FORMAT, time.gmtime(math.floor(until)))
+            if until is not None else '~')
+
+    def inside(text):
+        '''inside(text) - True if the raw time text falls in the window'''
+        if not text:
+            return False
+        if len(text) == 19 or (len(text) == 20 and text[19] == 'Z'):
+            return low <= text[:10] + 'T' + text[11:19] <= high
+        seconds = parse_time(text)
+        return ((since is None or seconds >= since) and
+                (until is None or seconds <= until))
+
+    return inside
+#
+###############################################################################
+#
+# _bbox_test()
+#
+def _bbox_test(bbox=None):
+    '''
+    _bbox_test(bbox) - Predicate on (lat, lon), or None for no bounding box
+
+    bbox is (west, south, east, north) in degrees, a west greater than east crosses the
+    antimeridian.
+    '''
+    if not bbox:
+        return None
+
+    west, south, east, north = bbox
+    if west <= east:
+        return lambda lat, lon: south <= lat <= north and west <= lon <= east
+    return lambda lat, lon: south <= lat <= north and (lon >= west or lon <= east)
+#
+###############################################################################
+#
+# iter_gpx()
+#
+def iter_gpx(source=None, batch_size=DEFAULT_BATCH_SIZE, since=None, until=None, bbox=None):
+    '''
+    iter_gpx(source, batch_size=DEFAULT_BATCH_SIZE, since=None, until=None, bbox=None)
+
+    Generate track events from a GPX file. The file is read incrementally and finished
+    elements are released as soon as they have been handed on, so memory stays bounded
+    by batch_size rather than file size.
+
+    since and until (seconds since the epoch) and bbox (west, south, east, north) select
+    points while parsing. They are tested against the raw attribute and <time> text, so
+    rejected points never become a TrackPoint. Segments left without points, and tracks
+    left without segments, are not reported at all.
+    '''
+    if None in [source]:
+        raise RuntimeError("No GPX source to read!")
+
+    batch_size = batch_size or DEFAULT_BATCH_SIZE
+    in_window = _time_window(since, until)
+    in_bbox = _bbox_test(bbox)
+    selecting = in_window is not None or in_bbox is not None
+    names = {}
+    namespaces = {}
+    parents = []
+    batch = []
+    track_name = None
+    track_started = False
+    segment_started = False
+
+    for event, element in ElementTree.iterparse(source, events=('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            prefix, uri = element
+            namespaces.setdefault(uri, prefix)
+            continue
+
+        # every point repeats the same few tags, strip their namespaces only once
+        name = names.get(element.tag)
+        if name is None:
+            name = names[element.tag] = _local_name(element.tag)
+
+        if event == 'start':
+            if not parents:
+                yield 'gpx', (dict(element.attrib), dict(namespaces))
+            elif name == 'trk':
+                track_name = None
+                track_started = False
+            elif name == 'trkseg':
+                segment_started = False
+                # when selecting, the segment is only started by its first surviving point
+                if not selecting:
+                    if not track_started:
+                        track_started = True
+                        yield 'track', track_name
+                    segment_started = True
+                    yield 'segment', None
+            parents.append(element)
+            continue
+
+        parents.pop()
+        parent = parents[-1] if parents else None
+
+        if name == 'trkpt':
+            parent.remove(element)
+            latitude = float(element.get('lat'))
+            longitude = float(element.get('lon'))
+            if in_bbox is not None and not in_bbox(latitude, longitude):
+                continue
+            point_time = _child_text(element, 'time')
+            if in_window is not None and not in_window(point_time):
+                continue
+
+            if not segment_started:
+                if not track_started:
+                    track_started = True
+                    yield 'track', track_name
+                segment_started = True
+                yield 'segment', None
+            elevation = _child_text(element, 'ele')
+            batch.append(TrackPoint(latitude, longitude, float(elevation) if elevation else None,
+                                    point_time, element))
+            if len(batch) >= batch_size:
+                yield 'points', batch
+                batch = []
+        elif name == 'name' and parent is not None and names[parent.tag] == 'trk':
+            track_name = element.text
+        elif name == 'trkseg':
+            if batch:
+                yield 'points', batch
+                batch = []
+            if segment_started:
+                yield 'end_segment', None
+            parent.remove(element)
+        elif name == 'trk':
+            if not (track_started or selecting):
+                track_started = True
+                yield 'track', track_name
+            if track_started:
+                yield 'end_track', None
+            parent.remove(element)
+        elif parent is not None and parent is parents[0]:
+            # waypoints, routes and metadata are not streamed, drop them
+            parent.remove(element)
+#
+###############################################################################
+#
+# _qualify()
+#
+def _qualify(tag, prefixes, declare):
+    '''
+    _qualify(tag, prefixes, declare) - Turn '{uri}name' into 'prefix:name'
+
+    Namespaces missing from prefixes are given a generated prefix and recorded in
+    declare so the caller can add the xmlns attribute.
+    '''
+    if tag.startswith('{'):
+        uri, local = tag[1:].split('}', 1)
+        if uri in prefixes:
+            prefix = prefixes[uri]
+        else:
+            prefix = declare.setdefault(uri, 'ns{}'.format(len(declare)))
+        return '{}:{}'.format(prefix, local) if prefix else local
+    return tag
+#
+###############################################################################
+#
+# _serialize_element()
+#
+def _serialize_element(element, prefixes, declare):
+    '''_serialize_element(element, prefixes, declare) - Element and children as XML text'''
+    tag = _qualify(element.tag, prefixes, declare)
+    parts = ['<', tag]
+    for key, value in element.attrib.items():
+        parts.append(' {}="{}"'.format(_qualify(key, prefixes, declare),
+                                       escape(value, {'"': '&quot;'})))
+    if element.text or len(element):
+        parts.append('>')
+        parts.append(escape(element.text or ''))
+        for child in element:
+            parts.append(_serialize_element(child, prefixes, declare))
+            parts.append(escape(child.tail or ''))
+        parts.append('</{}>'.format(tag))
+    else:
+        parts.append('/>')
+    return ''.join(parts)
+#
+###############################################################################
+#
+# _apply_position()
+#
+def _apply_position(point):
+    '''
+    _apply_position(point) - Write a moved TrackPoint's position back into its element
+
+    Stages such as smoothing only change the TrackPoint, so the element is updated here,
+    for the points actually written, and only where the values differ.
+    '''
+    element = point.element
+    if (float(element.get('lat')) != point.latitude or
+            float(element.get('lon')) != point.longitude):
+        element.set('lat', '{:.7f}'.format(point.latitude))
+        element.set('lon', '{:.7f}'.format(point.longitude))
+    if point.elevation is not None:
+        for child in element:
+            if _local_name(child.tag) == 'ele':
+                if float(child.text) != point.elevation:
+                    child.text = '{:.2f}'.format(point.elevation)
+                break
+#
+###############################################################################
+#
+# serialize_point()
+#
+def serialize_point(point=None, prefixes=None):
+    '''
+    serialize_point(point, prefixes=None) - A TrackPoint as a single line <trkpt> element
+    '''
+    output = ''
+    if None not in [point]:
+        if point.element is not None:
+            _apply_position(point)
+            declare = {}
+            output = _serialize_element(point.element, prefixes or {}, declare)
+            if declare:
+                # namespaces first seen below the root are declared on the point itself
+                split = output.index(' ')
+                output = output[:split] + ''.join(
+                    ' xmlns:{}="{}"'.format(prefix, escape(uri, {'"': '&quot;'}))
+                    for uri, prefix in declare.items()) + output[split:]
+        else:
+            output = '<trkpt lat="{!r}" lon="{!r}">'.format(point.latitude, point.longitude)
+            if point.elevation is not None:
+                output += '<ele>{!r}</ele>'.format(point.elevation)
+            if point.time:
+                output += '<time>{}</time>'.format(escape(point.time))
+            output += '</trkpt>'
+    return output
+#
+###############################################################################
+#
+# serialize_event()
+#
+def serialize_event(kind=None, value=None, prefixes=None):
+    '''
+    serialize_event(kind, value, prefixes=None) - GPX text for a single track event
+
+    prefixes is the {uri: prefix} map from the 'gpx' event. The closing GPX_FOOTER is
+    left to the caller.
+    '''
+    output = ''
+    if kind == 'gpx':
+        attrib, prefixes = value
+        header = ['<gpx']
+        for uri, prefix in prefixes.items():
+            header.append(' xmlns{}="{}"'.format(':' + prefix if prefix else '',
+                                                 escape(uri, {'"': '&quot;'})))
+        for key, attr in attrib.items():
+            header.append(' {}="{}"'.format(_qualify(key, prefixes, {}),
+                                           escape(attr, {'"': '&quot;'})))
+        output = XML_DECLARATION + ''.join(header) + '>\n'
+    elif kind == 'track':
+        output = '<trk>\n' + ('<name>{}</name>\n'.format(escape(value)) if value else '')
+    elif kind == 'segment':
+        output = '<trkseg>\n'
+    elif kind == 'points':
+        output = ''.join(serialize_point(point, prefixes) + '\n' for point in value)
+    elif kind == 'end_segment':
+        output = '</trkseg>\n'
+    elif kind == 'end_track':
+        output = '</trk>\n'
+    return output
+#
+###############################################################################
+#
+# gpx_chunks()
+#
+def gpx_chunks(events=None):
+    '''
+    gpx_chunks(events) - Serialize a stream of track events back into GPX text chunks
+    '''
+    prefixes = {}
+    started = False
+
+    for kind, value in events or []:
+        if kind == 'gpx':
+            prefixes = value[1]
+            started = True
+        yield serialize_event(kind, value, prefixes)
+
+    if started:
+        yield GPX_FOOTER
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Tracks as coordinate and time arrays for use from Python rather than the CLI
+'''
+#
+# Standard Imports
+#
+import array
+import collections
+#
+# Optional imports
+#
+try:
+    import numpy
+except ImportError:
+    numpy = None
+#
+# Local imports
+#
+from gpx_stream import NAN, iter_gpx, parse_time
+#
+##############################################################################
+#
+# Global variables
+#
+ARRAY_TYPECODE = 'd'
+#
+# Every field of a Segment is an array of float64 of the same length: array.array
+# (buffer protocol) or, when NumPy is in use, a zero-copy numpy view of one.
+# 'time' is seconds since the epoch and missing elevations or times are NaN.
+#
+Segment = collections.namedtuple('Segment', ['latitude', 'longitude', 'elevation', 'time'])
+Track = collections.namedtuple('Track', ['name', 'segments'])
+#
+###############################################################################
+#
+# new_segment()
+#
+def new_segment():
+    '''new_segment() - An empty Segment of growable array.array columns'''
+    return Segment(*[array.array(ARRAY_TYPECODE) for _ in Segment._fields])
+#
+###############################################################################
+#
+# extend_segment()
+#
+def extend_segment(segment=None, points=None):
+    '''
+    extend_segment(segment, points) - Append TrackPoint-like points to a new_segment()
+
+    Points need latitude, longitude, elevation and time attributes, time may be ISO 8601
+    text or seconds since the epoch.
+    '''
+    if None not in [segment, points]:
+        for point in points:
+            segment.latitude.append(point.latitude)
+            segment.longitude.append(point.longitude)
+            segment.elevation.append(NAN if point.elevation is None else point.elevation)
+            if isinstance(point.time, str):
+                segment.time.append(parse_time(point.time))
+            else:
+                segment.time.append(NAN if point.time is None else point.time)
+    return segment
+#
+###############################################################################
+#
+# to_numpy()
+#
+def to_numpy(segment=None):
+    '''
+    to_numpy(segment) - Wrap each array.array column as a numpy array without copying
+
+    The segment is returned unchanged if NumPy is not installed.
+    '''
+    if numpy is None or segment is None or isinstance(segment.latitude, numpy.ndarray):
+        return segment
+    return Segment(*[numpy.frombuffer(column, dtype=numpy.float64) for column in segment])
+#
+###############################################################################
+#
+# finish_segment()
+#
+def finish_segment(segment=None, use_numpy=None):
+    '''
+    finish_segment(segment, use_numpy=None) - A completed segment as handed to callers
+
+    use_numpy defaults to whether NumPy can be imported. The segment must not be
+    extended afterwards, numpy views share the array.array buffers.
+    '''
+    use_numpy = numpy is not None if use_numpy is None else use_numpy
+    return to_numpy(segment) if use_numpy else segment
+#
+###############################################################################
+#
+# collect_tracks()
+#
+def collect_tracks(events=None, use_numpy=None):
+    '''
+    collect_tracks(events, use_numpy=None) - Build Tracks of array Segments from track events
+
+    use_numpy defaults to whether NumPy can be imported.
+    '''
+    tracks = []
+    segment = None
+
+    for kind, value in events or []:
+        if kind == 'track':
+            tracks.append(Track(value, []))
+        elif kind == 'segment':
+            segment = new_segment()
+        elif kind == 'points':
+            extend_segment(segment, value)
+        elif kind == 'end_segment':
+            tracks[-1].segments.append(finish_segment(segment, use_numpy))
+            segment = None
+
+    return tracks
+#
+###############################################################################
+#
+# read_tracks()
+#
+def read_tracks(source=None, use_numpy=None, selection=None):
+    '''
+    read_tracks(source, use_numpy=None, selection=None) - Read a GPX path or file into Tracks
+
+    Points are streamed straight into arrays, no per-point objects are kept. selection is
+    an optional dict of since, until and bbox arguments for gpx_stream.iter_gpx().
+    '''
+    if None in [source]:
+        raise RuntimeError("No GPX source to read!")
+
+    return collect_tracks(iter_gpx(source, **(selection or {})), use_numpy)
@@ -20,7 +20,7 @@ from geojson import dumps, Feature, LineString, Point
 #
 # Ensure ./lib is in the lib path for local includes
 #
-sys.path.append(os.path.realpath(os.path.join('.', 'lib')))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib'))
 #
 ##############################################################################
 #
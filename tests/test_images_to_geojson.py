@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+'''
+Tests for the photo clustering in images_to_geojson.py
+'''
+#
+# Standard Imports
+#
+import math
+import os
+import sys
+import unittest
+#
+# Ensure the repository root is in the path for the scripts
+#
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+#
+# Local imports
+#
+# pylint: disable=wrong-import-position
+import images_to_geojson
+#
+##############################################################################
+#
+# _across_row_boundary()
+#
+def _across_row_boundary(lat, lon, distance, cell_size):
+    '''
+    _across_row_boundary(lat, lon, distance, cell_size) - Two points distance metres apart
+
+    The points sit either side of the grid row boundary nearest lat, on a north-east
+    diagonal, as (lat, lon, ele, date) tuples.
+    '''
+    size = cell_size / images_to_geojson.METRES_PER_DEGREE
+    edge = round(lat / size) * size
+    d_lat = distance / math.sqrt(2) / images_to_geojson.METRES_PER_DEGREE
+    d_lon = d_lat / math.cos(math.radians(edge))
+    return [(edge - d_lat / 2, lon - d_lon / 2, None, None),
+            (edge + d_lat / 2, lon + d_lon / 2, None, None)]
+#
+###############################################################################
+#
+# ClusterPointsTest
+#
+class ClusterPointsTest(unittest.TestCase):
+    '''cluster_points() merging across the grid'''
+
+    def test_merges_across_row_boundary(self):
+        '''Photos 50 m apart either side of a row boundary form one cluster'''
+        for lat in [0.5, 37.7, 55.3, 64.9, -60.2]:
+            for lon in [-179.6, -122.4, 0.1, 18.03, 151.2, 179.8]:
+                points = _across_row_boundary(lat, lon, 50.0, 100.0)
+                clusters = images_to_geojson.cluster_points(points, cell_size=100.0)
+                self.assertEqual(len(clusters['features']), 1, (lat, lon))
+                self.assertEqual(clusters['features'][0]['properties']['count'], 2)
+
+    def test_keeps_distant_photos_apart(self):
+        '''Photos a kilometre apart stay separate clusters'''
+        points = _across_row_boundary(59.33, 179.8, 1000.0, 100.0)
+        clusters = images_to_geojson.cluster_points(points, cell_size=100.0)
+        self.assertEqual(len(clusters['features']), 2)
+
+if __name__ == '__main__':
+    unittest.main()